@@ -29,6 +29,10 @@ import numpy as np
 import argparse
 import typing as tp
 import h5py
+import os
+import tempfile
+import concurrent.futures as cf
+import multiprocessing as mp
 
 
 def create_monthly_count_tb(
@@ -43,7 +47,10 @@ def create_monthly_count_tb(
     Create a table with simplified post-codes, months, and number of companies generated
     under these simplified postcodes. The simplified postcodes are created by throwing away
     some of the trailing characters. This leads to simplified postcodes that get assigned
-    to georgraphically co-located addresses. The table is created in the DuckDB memory. Schema
+    to georgraphically co-located addresses. The simplified postcodes are computed once, by
+    `extract_data.py`, and stored in the `simplified_pc` column. The table is created in the
+    DuckDB memory. The monthly counts are stored as 16-bit integers, DuckDB raises a conversion
+    error should any of them not fit. Schema
 
     | simplified_pc | inc_monthly_count | relative_month |
     |---------------|-------------------|----------------|
@@ -51,10 +58,10 @@ def create_monthly_count_tb(
     etc.
 
     To work, the function requires the `source_table` with:
-        -  company_number
-        - address_post_code
+        - simplified_pc
         - inc_date
-    To be present
+    To be present. Each company is expected to appear only once in `source_table`,
+    so the companies are counted by rows
 
     Only the companies with incorporation date that falls within the specified period, will be
     grouped together. The incorporation date well be given as `relative_month` - number of
@@ -74,27 +81,28 @@ def create_monthly_count_tb(
         WITH
         post_code_vw AS (
             SELECT
-                company_number,
-                address_post_code,
+                simplified_pc,
                 inc_date,
-                DATE_DIFF('DAY', DATE '{relative_date_str}', inc_date) AS rel_day_count,
-                DATE_DIFF('MONTH', DATE '{relative_date_str}', inc_date) AS rel_month_count,
-                DATE_DIFF('YEAR', DATE '{relative_date_str}', inc_date) AS rel_year_count,
-                REPLACE(SUBSTRING(address_post_code, 1, STRLEN(address_post_code)-2), ' ', '') AS simplified_pc
+                DATE_DIFF('MONTH', $relative_date::DATE, inc_date) AS rel_month_count,
             FROM {source_table}
             WHERE
-                inc_date >= DATE '{period_start_date_str}'
-                AND inc_date <= DATE '{period_end_date_str}' 
-                AND address_post_code IS NOT NULL
+                inc_date >= $period_start_date::DATE
+                AND inc_date <= $period_end_date::DATE
+                AND simplified_pc IS NOT NULL
         )
 
         SELECT
             simplified_pc,
-            COUNT(DISTINCT company_number) AS inc_monthly_count,
+            CAST(COUNT(*) AS SMALLINT) AS inc_monthly_count,
             rel_month_count AS relative_month
         FROM post_code_vw
         GROUP BY simplified_pc, rel_month_count
-        """
+        """,
+        {
+            'relative_date': relative_date_str,
+            'period_start_date': period_start_date_str,
+            'period_end_date': period_end_date_str
+        }
     )
 
     return dbcon
@@ -108,7 +116,9 @@ def extract_incroporation_series_batch(
         int_batch_start_pos: int=0,
         int_batch_stop_pos: tp.Optional[int]=None,
         min_relative_month: tp.Optional[int]=None,
-        max_relative_month: tp.Optional[int]=None
+        max_relative_month: tp.Optional[int]=None,
+        batch_count: tp.Optional[int]=None,
+        batch_id: int=0
 )->tp.Tuple[tp.List[str], np.ndarray]:
     """
     Extract time series data on company creation dates as N*M matrix, with N postcodes
@@ -119,6 +129,11 @@ def extract_incroporation_series_batch(
     by hash (with hash-salt `sort_hash_salt`) and then the selected batch
     is int_batch_start_pos...int_batch_stop_pos
 
+    Alternatively, if `batch_count` is given, the postcodes are split into `batch_count`
+    batches by the hash (with the same hash-salt) modulo `batch_count`, and the batch
+    `batch_id` is selected. The batch positions are ignored in that case. This avoids
+    ordering all of the postcodes, but the batches are only approximately equal in size
+
     :param dbcon: connector to DuckDB. We expect to have table `inc_table_name` in there
                     see `create_monthly_count_tb`
     :param inc_table_name: name of the table to extract the data from
@@ -129,153 +144,222 @@ def extract_incroporation_series_batch(
                 if None, the minimum possible month is taken
     :param max_relative_month: maximum of the relative months to consider,
                 if None, the maximum possible month is taken
-    :return: [list of postodes], [N*M numpy matrix]
+    :param batch_count: number of batches to split the postcodes into by hash,
+                if None, the batch is selected by `int_batch_start_pos` and `int_batch_stop_pos`
+    :param batch_id: batch to select when `batch_count` is given, 0...batch_count-1
+    :return: [list of postodes], [N*M numpy matrix of 16-bit integers]
     """
 
-    # get a list of all postcodes ordered by the hash-salt
-    # and prepare the selection window
-    pc_df = dbcon.execute(
-        f"""
-        WITH
-        -- assign numbers to post-codes
-        sorted_pc_vw AS (
+    if batch_count is None:
+        # assign numbers to all postcodes ordered by the hash-salt,
+        # materialized once so that the later queries do not repeat
+        # the distinct + hash + row-number scan
+        dbcon.execute(
+            f"""
+            CREATE OR REPLACE TEMP TABLE sorted_pc_tb AS
             SELECT
                 simplified_pc,
-                ROW_NUMBER() OVER(ORDER BY HASH(CONCAT(simplified_pc, '{sort_hash_salt}'))) AS sorted_pc_order
-            FROM (SELECT DISTINCT simplified_pc FROM {inc_table_name})
+                ROW_NUMBER() OVER(ORDER BY HASH(CONCAT(simplified_pc, $sort_hash_salt))) AS sorted_pc_order
+            FROM (SELECT simplified_pc FROM {inc_table_name} GROUP BY simplified_pc)
+            """,
+            {'sort_hash_salt': sort_hash_salt}
         )
-        
-        SELECT
-            *
-        FROM sorted_pc_vw
-        """
-    ).fetchdf()
 
-    if int_batch_stop_pos is None:
-        int_batch_stop_pos = pc_df.sorted_pc_order.max()
+        if int_batch_stop_pos is None:
+            int_batch_stop_pos = dbcon.execute(
+                "SELECT MAX(sorted_pc_order) FROM sorted_pc_tb"
+            ).fetchone()[0]
 
-    # get the min-max months
-    minmax_df = dbcon.execute(
-        f"""
-            WITH
-            -- assign numbers to post-codes
-            sorted_pc_vw AS (
+        # selected post-codes, with their row position in the output matrix
+        dbcon.execute(
+            f"""
+            CREATE OR REPLACE TEMP TABLE chosen_pc_tb AS
+            SELECT
+                simplified_pc,
+                ROW_NUMBER() OVER(ORDER BY sorted_pc_order) - 1 AS batch_pc_idx
+            FROM sorted_pc_tb
+            WHERE 
+                sorted_pc_order >= $int_batch_start_pos
+                AND
+                sorted_pc_order <= $int_batch_stop_pos
+            """,
+            {'int_batch_start_pos': int_batch_start_pos, 'int_batch_stop_pos': int_batch_stop_pos}
+        )
+    else:
+        assert 0 <= batch_id < batch_count, 'Batch id must be within 0...batch_count-1'
+
+        # pick the batch by the hash-salt modulo the number of batches,
+        # this avoids ordering all of the postcodes, only the chosen ones
+        # get ordered to fix their row position in the output matrix
+        dbcon.execute(
+            f"""
+            CREATE OR REPLACE TEMP TABLE chosen_pc_tb AS
+            SELECT
+                simplified_pc,
+                ROW_NUMBER() OVER(ORDER BY pc_hash) - 1 AS batch_pc_idx
+            FROM (
                 SELECT
                     simplified_pc,
-                    ROW_NUMBER() OVER(ORDER BY HASH(CONCAT(simplified_pc, '{sort_hash_salt}'))) AS sorted_pc_order
-                FROM (SELECT DISTINCT simplified_pc FROM {inc_table_name})
+                    HASH(CONCAT(simplified_pc, $sort_hash_salt)) AS pc_hash
+                FROM (SELECT simplified_pc FROM {inc_table_name} GROUP BY simplified_pc)
             )
-            ,
-            -- selected post-codes
-            chosen_pc_vw AS (
-                SELECT
-                    simplified_pc
-                FROM sorted_pc_vw
-                WHERE 
-                    sorted_pc_order >= {int_batch_start_pos}
-                    AND
-                    sorted_pc_order <= {int_batch_stop_pos}
-            )
-            ,
-            -- select matching records
-            chosen_vw AS (
-                SELECT
-                    *
-                FROM {inc_table_name}
-                WHERE simplified_pc IN (SELECT simplified_pc FROM chosen_pc_vw)
-            )
-            ,
-            -- min/max relative month
-            minmax_vw AS (
+            WHERE pc_hash % $batch_count = $batch_id
+            """,
+            {'sort_hash_salt': sort_hash_salt, 'batch_count': batch_count, 'batch_id': batch_id}
+        )
+
+    # get the min-max months, only if the caller did not supply them
+    if (min_relative_month is None) or (max_relative_month is None):
+        found_min_relative_month, found_max_relative_month = dbcon.execute(
+            f"""
+            SELECT
+                MIN(relative_month) AS min_relative_month,
+                MAX(relative_month) AS max_relative_month
+            FROM {inc_table_name}
+            SEMI JOIN chosen_pc_tb USING (simplified_pc)
+            """
+        ).fetchone()
+
+        # hash-modulo batches are uneven and can come out empty, in that case
+        # fall back to the months of the whole table, giving an empty 0*M matrix
+        if found_min_relative_month is None:
+            found_min_relative_month, found_max_relative_month = dbcon.execute(
+                f"""
                 SELECT
                     MIN(relative_month) AS min_relative_month,
                     MAX(relative_month) AS max_relative_month
-                FROM chosen_vw
-            )
-            
-            SELECT
-                *
-            FROM minmax_vw
-            """
-    ).fetchdf()
+                FROM {inc_table_name}
+                """
+            ).fetchone()
 
-    if min_relative_month is None:
-        min_relative_month = minmax_df.min_relative_month.iloc[0]
+        if min_relative_month is None:
+            min_relative_month = found_min_relative_month
 
-    if max_relative_month is None:
-        max_relative_month = minmax_df.max_relative_month.iloc[0]
+        if max_relative_month is None:
+            max_relative_month = found_max_relative_month
 
-    # get the number of incorporated companies as table with arrays
-    arr_df = dbcon.execute(
+    # list of the chosen post-codes, in the batch order.
+    # Results are fetched as numpy columns, skipping the pandas data-frames
+    pc_list = dbcon.execute(
+        """
+        SELECT
+            simplified_pc
+        FROM chosen_pc_tb
+        ORDER BY batch_pc_idx
+        """
+    ).fetchnumpy()['simplified_pc']
+
+    # get the number of incorporated companies, only for the months
+    # where there were any, the zeros are filled in below
+    count_dict = dbcon.execute(
         f"""
-            WITH
-            -- assign numbers to post-codes
-            sorted_pc_vw AS (
-                SELECT
-                    simplified_pc,
-                    ROW_NUMBER() OVER(ORDER BY HASH(CONCAT(simplified_pc, '{sort_hash_salt}'))) AS sorted_pc_order
-                FROM (SELECT DISTINCT simplified_pc FROM {inc_table_name})
-            )
-            ,
-            -- selected post-codes
-            chosen_pc_vw AS (
-                SELECT
-                    simplified_pc
-                FROM sorted_pc_vw
-                WHERE 
-                    sorted_pc_order >= {int_batch_start_pos}
-                    AND
-                    sorted_pc_order <= {int_batch_stop_pos}
-            )
-            ,
-            -- select matching records
-            chosen_vw AS (
-                SELECT
-                    *
-                FROM {inc_table_name}
-                WHERE simplified_pc IN (SELECT simplified_pc FROM chosen_pc_vw)
-            )
-            ,
-            -- months
-            pc_month_vw AS (
-                SELECT
-                    M.* AS relative_month,
-                    P.*
-                FROM GENERATE_SERIES({min_relative_month}, {max_relative_month}) AS M
-                CROSS JOIN chosen_pc_vw AS P
-            )
-            ,
-            -- get counts for all the months
-            chosen_all_months_vw AS (
-                SELECT
-                    M.simplified_pc,
-                    M.relative_month,
-                    IFNULL(C.inc_monthly_count, 0) AS inc_monthly_count,
-                FROM pc_month_vw AS M
-                LEFT JOIN chosen_vw AS C
-                    ON C.relative_month=M.relative_month AND C.simplified_pc=M.simplified_pc
-            )
-            
-            -- aggregate counts into arrays
-            
-            SELECT
-                simplified_pc,
-                ARRAY_AGG(inc_monthly_count ORDER BY relative_month) AS inc_monthly_count_arr
-            FROM chosen_all_months_vw
-            GROUP BY simplified_pc
-            """
-    ).fetchdf()
+        SELECT
+            P.batch_pc_idx,
+            C.relative_month,
+            C.inc_monthly_count
+        FROM {inc_table_name} AS C
+        INNER JOIN chosen_pc_tb AS P USING (simplified_pc)
+        WHERE
+            C.relative_month >= $min_relative_month
+            AND
+            C.relative_month <= $max_relative_month
+        """,
+        {'min_relative_month': min_relative_month, 'max_relative_month': max_relative_month}
+    ).fetchnumpy()
 
     # extract results as a list of N post-codes
     # and an N*M matrix with observations for M months
-    pc_list = arr_df.simplified_pc.values
-    inc_counts = np.stack(arr_df.inc_monthly_count_arr.values, axis=0)
+    inc_counts = np.zeros([len(pc_list), max_relative_month - min_relative_month + 1], dtype=np.int16)
+    inc_counts[
+        count_dict['batch_pc_idx'],
+        count_dict['relative_month'] - min_relative_month
+    ] = count_dict['inc_monthly_count']
 
     ## extrcact array with all the months present
     return pc_list, inc_counts
 
 #######################
 
+def save_batch_h5(
+        batch_save_h5_file: str,
+        batch_pc_list: tp.List[str],
+        batch_counts_mat: np.ndarray,
+        period_start_date_str: str,
+        period_end_date_str: str
+):
+    """
+    Save the extracted batch as an H5 file, see `main` for the contents
+
+    :param batch_save_h5_file: destination for the extracted batch file
+    :param batch_pc_list: list of N simplified post-codes
+    :param batch_counts_mat: N*M time series matrix, saved with its own integer type
+    :param period_start_date_str: start of the period within which the time series were considered
+    :param period_end_date_str: end of the period within which the time series were considered
+    """
+    with h5py.File(batch_save_h5_file, 'w') as fh:
+        # one chunk per simplified postcode, so that single traces can be read
+        # without loading the whole matrix. Counts are mostly zeros and compress well
+        fh.create_dataset(
+            'time_series_mat',
+            data=batch_counts_mat,
+            chunks=(1, batch_counts_mat.shape[1]) if batch_counts_mat.size > 0 else None,
+            compression='lzf',
+            shuffle=True
+        )
+
+        # use
+        # ` with h5py.File('test.h5', 'r') as h5_fh: var=[pc.decode('utf-8') for pc in h5_fh['utf-8_simplified_pc_list'][:]];`
+        # to extract
+        fh.create_dataset('utf-8_simplified_pc_list', data=[pc.encode('utf-8') for pc in batch_pc_list])
+        fh.create_dataset('utf-8_period_start_date_str', data=period_start_date_str.encode('utf-8'))
+        fh.create_dataset('utf-8_period_end_date_str', data=period_end_date_str.encode('utf-8'))
+
+#######################
+
+def extract_batch_from_parquet(
+        aggregate_parquet: str,
+        sort_hash_salt: str,
+        batch_count: int,
+        batch_id: int,
+        min_relative_month: int,
+        max_relative_month: int,
+        db_thread_count: int=1
+)->tp.Tuple[tp.List[str], np.ndarray]:
+    """
+    Extract a single hash batch from the aggregate table saved as a parquet file. Meant to
+    run in a worker process, with its own DuckDB connector, see `main`
+
+    :param aggregate_parquet: parquet file with the table created by `create_monthly_count_tb`
+    :param sort_hash_salt: see `extract_incroporation_series_batch`
+    :param batch_count: see `extract_incroporation_series_batch`
+    :param batch_id: see `extract_incroporation_series_batch`
+    :param min_relative_month: see `extract_incroporation_series_batch`
+    :param max_relative_month: see `extract_incroporation_series_batch`
+    :param db_thread_count: number of threads for DuckDB in this worker
+    :return: list of simplified post-codes, N*M time series matrix
+    """
+    dbcon = ddb.connect()
+    dbcon.execute(f"PRAGMA threads={db_thread_count};")
+    dbcon.execute("PRAGMA preserve_insertion_order=false;")
+    dbcon.execute(
+        f"""
+        CREATE VIEW intermediate_pc_aggregate_table AS
+        SELECT * FROM read_parquet('{aggregate_parquet}');
+        """
+    )
+
+    return extract_incroporation_series_batch(
+        dbcon=dbcon,
+        inc_table_name='intermediate_pc_aggregate_table',
+        sort_hash_salt=sort_hash_salt,
+        min_relative_month=min_relative_month,
+        max_relative_month=max_relative_month,
+        batch_count=batch_count,
+        batch_id=batch_id
+    )
+
+#######################
+
 def main(
         input_db_name: str,
         period_start_date_str: str,
@@ -283,7 +367,12 @@ def main(
         batch_hash_salt: str='42fish',
         int_batch_start_pos: int=0,
         int_batch_stop_pos: tp.Optional[int]=None,
-        batch_save_h5_file: tp.Optional[str]=None
+        batch_save_h5_file: tp.Optional[str]=None,
+        batch_count: tp.Optional[int]=None,
+        batch_id: tp.Optional[int]=None,
+        batch_process_count: tp.Optional[int]=None,
+        db_thread_count: tp.Optional[int]=None,
+        db_memory_limit: tp.Optional[str]=None
 )->tp.Tuple[tp.List[str], np.ndarray]:
     """
     Shorten postcodes to get the simplified postcodes, that group co-located companies. Then extract
@@ -292,9 +381,15 @@ def main(
     and M number of months
 
     There is an option to save output as an H5 file which will contain:
-        time_series_mat - an N*M matrix full of integers
+        time_series_mat - an N*M matrix full of 16-bit integers
         batch_pc_list - array of simplified post code files, encoded as UTF-8
 
+    If `batch_count` is given without `batch_id`, all of the hash batches are extracted in one go.
+    The aggregate table is built once, saved to a temporary parquet file, and the batches are
+    extracted from it by a pool of `batch_process_count` worker processes. All batches share the same
+    months, and the returned results are the batches stacked together. The H5 file for every batch
+    gets the batch id appended to its name, e.g. `extracted_time_series_batch_3.h5`
+
     :param input_db_name: source database, see `extract_incroporation_series_batch`
     :param period_start_date_str: start of the period within which to consider time series, see `extract_incroporation_series_batch`
     :param period_end_date_str: end of the period within which to consider time series, see `extract_incroporation_series_batch`
@@ -302,13 +397,38 @@ def main(
     :param int_batch_start_pos: start position (integer) of the simplified postcodes batch, for extraction (inclusive)
     :param int_batch_stop_pos: stop position (integer) of the simplified postcodes batch, for extraction (exclusive)
     :param batch_save_h5_file: destination for the extracted batch file.
+    :param batch_count: number of hash batches to split simplified postcodes into, used instead of the batch positions,
+                see `extract_incroporation_series_batch`
+    :param batch_id: id of the hash batch to extract, 0...batch_count-1, if None, all batches are extracted
+    :param batch_process_count: number of worker processes when extracting all batches, if None, one per CPU core
+    :param db_thread_count: number of threads for DuckDB, if None, all the CPU cores are used
+    :param db_memory_limit: memory limit for DuckDB, e.g. '8GB', if None, DuckDB default is kept
     :return: list of simplified post-codes, N*M time series matrix
     """
 
+    if db_thread_count is None:
+        db_thread_count = os.cpu_count()
+
     # create a db connector
     print('Creating DB connector ... ', end='')
     dbcon = ddb.connect()
-    dbcon.execute(f"CREATE TABLE companies_house AS FROM '{input_db_name}';")
+    dbcon.execute(f"PRAGMA threads={db_thread_count};")
+    if db_memory_limit is not None:
+        dbcon.execute(f"PRAGMA memory_limit='{db_memory_limit}';")
+    # none of the queries rely on the order of rows, unless it is explicitly requested
+    dbcon.execute("PRAGMA preserve_insertion_order=false;")
+
+    # only a view over the parquet file, so that just the needed columns get
+    # read, and the date filter can skip row-groups within the parquet reader
+    dbcon.execute(
+        f"""
+        CREATE VIEW companies_house AS
+        SELECT
+            simplified_pc,
+            inc_date
+        FROM read_parquet('{input_db_name}');
+        """
+    )
     print('Done')
 
     ############
@@ -325,13 +445,71 @@ def main(
 
     ####
 
+    if (batch_count is not None) and (batch_id is None):
+        print(f'Extracting all {batch_count} time series batches ... ', end='')
+        min_relative_month, max_relative_month = dbcon.execute(
+            f"SELECT MIN(relative_month), MAX(relative_month) FROM {intermediate_pc_aggregate_table}"
+        ).fetchone()
+
+        if batch_process_count is None:
+            batch_process_count = os.cpu_count()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # the workers read the aggregate table from the file, instead of rebuilding it
+            aggregate_parquet = os.path.join(tmp_dir, f'{intermediate_pc_aggregate_table}.parquet')
+            dbcon.execute(f"COPY {intermediate_pc_aggregate_table} TO '{aggregate_parquet}' (FORMAT PARQUET);")
+
+            # DuckDB is multi-threaded itself, so the threads get split between the workers.
+            # Worker processes are spawned, since forking a process with DuckDB threads running is unsafe
+            with cf.ProcessPoolExecutor(
+                max_workers=batch_process_count,
+                mp_context=mp.get_context('spawn')
+            ) as pool:
+                batch_future_list = [
+                    pool.submit(
+                        extract_batch_from_parquet,
+                        aggregate_parquet=aggregate_parquet,
+                        sort_hash_salt=batch_hash_salt,
+                        batch_count=batch_count,
+                        batch_id=cur_batch_id,
+                        min_relative_month=min_relative_month,
+                        max_relative_month=max_relative_month,
+                        db_thread_count=max(1, db_thread_count // batch_process_count)
+                    )
+                    for cur_batch_id in range(batch_count)
+                ]
+                batch_result_list = [batch_future.result() for batch_future in batch_future_list]
+        print('Done')
+
+        ### saving results
+        print('Saving result ... ', end='')
+        if batch_save_h5_file is not None:
+            for cur_batch_id, (batch_pc_list, batch_counts_mat) in enumerate(batch_result_list):
+                save_batch_h5(
+                    batch_save_h5_file=batch_save_h5_file.replace('.h5', '') + f'_{cur_batch_id}.h5',
+                    batch_pc_list=batch_pc_list,
+                    batch_counts_mat=batch_counts_mat,
+                    period_start_date_str=period_start_date_str,
+                    period_end_date_str=period_end_date_str
+                )
+            print(f'Done. {batch_count} files like {batch_save_h5_file}')
+        else:
+            print('Not needed')
+
+        batch_pc_list = np.concatenate([batch_pc_list for batch_pc_list, _ in batch_result_list])
+        batch_counts_mat = np.concatenate([batch_counts_mat for _, batch_counts_mat in batch_result_list], axis=0)
+
+        return batch_pc_list, batch_counts_mat
+
     print('Extracting time series batch ... ', end='')
     batch_pc_list, batch_counts_mat = extract_incroporation_series_batch(
         dbcon=dbcon,
-        inc_table_name='intermediate_pc_aggregate_table',
+        inc_table_name=intermediate_pc_aggregate_table,
         int_batch_start_pos=int_batch_start_pos,
         int_batch_stop_pos=int_batch_stop_pos,
-        sort_hash_salt=batch_hash_salt
+        sort_hash_salt=batch_hash_salt,
+        batch_count=batch_count,
+        batch_id=batch_id
     )
     print('Done')
 
@@ -339,16 +517,13 @@ def main(
     print('Saving result ... ', end='')
     if batch_save_h5_file is not None:
         # save the batch
-        with h5py.File(batch_save_h5_file, 'w') as fh:
-            fh.create_dataset('time_series_mat', data=batch_counts_mat)
-
-            # use
-            # ` with h5py.File('test.h5', 'r') as h5_fh: var=[pc.decode('utf-8') for pc in h5_fh['utf-8_simplified_pc_list'][:]];`
-            # to extract
-            fh.create_dataset('utf-8_simplified_pc_list', data=[pc.encode('utf-8') for pc in batch_pc_list])
-            fh.create_dataset('utf-8_period_start_date_str', data=period_start_date_str.encode('utf-8'))
-            fh.create_dataset('utf-8_period_end_date_str', data=period_end_date_str.encode('utf-8'))
-
+        save_batch_h5(
+            batch_save_h5_file=batch_save_h5_file,
+            batch_pc_list=batch_pc_list,
+            batch_counts_mat=batch_counts_mat,
+            period_start_date_str=period_start_date_str,
+            period_end_date_str=period_end_date_str
+        )
         print(f'Done. {batch_save_h5_file}')
     else:
         print('Not needed')
@@ -403,12 +578,47 @@ if __name__ == '__main__':
         default=None
     )
     #
+    parser.add_argument(
+        '--batch_count',
+        type=int,
+        help='Number of hash batches to split the simplified post-codes into, used instead of the batch positions',
+        default=None
+    )
+    #
+    parser.add_argument(
+        '--batch_id',
+        type=int,
+        help='Id of the hash batch that will be extracted (0...batch_count-1), all batches are extracted if not given',
+        default=None
+    )
+    #
+    parser.add_argument(
+        '--batch_process_count',
+        type=int,
+        help='Number of worker processes when extracting all hash batches (defaults to the number of CPU cores)',
+        default=None
+    )
+    #
     parser.add_argument(
         '--batch_save_h5_file',
         type=str,
         help='Name of the H5 file into which the extracted batch will be saved',
         default='extracted_time_series_batch.h5'
     )
+    #
+    parser.add_argument(
+        '--db_thread_count',
+        type=int,
+        help='Number of threads for DuckDB to use (defaults to the number of CPU cores)',
+        default=None
+    )
+    #
+    parser.add_argument(
+        '--db_memory_limit',
+        type=str,
+        help='Memory limit for DuckDB, e.g. 8GB (defaults to the DuckDB default)',
+        default=None
+    )
     # Parse the arguments
     args = parser.parse_args()
     # Extract the argument values
@@ -420,6 +630,11 @@ if __name__ == '__main__':
         batch_hash_salt=args.batch_hash_salt,
         int_batch_start_pos=args.int_batch_start_pos,
         int_batch_stop_pos=args.int_batch_stop_pos,
-        batch_save_h5_file=args.batch_save_h5_file
+        batch_save_h5_file=args.batch_save_h5_file,
+        batch_count=args.batch_count,
+        batch_id=args.batch_id,
+        batch_process_count=args.batch_process_count,
+        db_thread_count=args.db_thread_count,
+        db_memory_limit=args.db_memory_limit
     )
 
@@ -37,12 +37,7 @@ if __name__ == '__main__':
     dir_path = os.path.abspath('.')
     csv_path_list = []
 
-    # prepare db context
-    con = duckdb.connect()
-
     # Traverse the directory structure
-    file_counter = 1
-    tb_name_list = []
     for root, dirs, files in os.walk(dir_path):
         for file_path in files:
             if file_path.lower().endswith('.zip'):
@@ -63,27 +58,23 @@ if __name__ == '__main__':
 
                 csv_path_list.append(suggested_csv_path)
 
-                # load into database
-                cur_tb_name = f'compnanies_house_tb_{file_counter}'
-                con.execute(
-                    f"""
-                    CREATE TABLE {cur_tb_name} AS FROM '{suggested_csv_path}';
-                    """
-                )
-                tb_name_list.append(cur_tb_name)
-                file_counter += 1
-                print(f'\tLoaded table {cur_tb_name}')
-
-    # combine into a single table
-    combine_sql = 'SELECT * FROM ('
-    combine_sql += ' UNION ALL '.join([f' SELECT * FROM {tb_name} ' for tb_name in tb_name_list])
-    combine_sql += ')'
+    # prepare db context
+    con = duckdb.connect()
+
+    # read all of the CSVs as one source, rather than loading each into its own table
+    # and combining them, so that DuckDB can scan the files in parallel
+    csv_list_sql = '[' + ', '.join([f"'{csv_path}'" for csv_path in csv_path_list]) + ']'
+    combine_sql = f'SELECT * FROM read_csv({csv_list_sql}, union_by_name=true, auto_detect=true)'
+
+    # parquet settings shared by both exports, the rows get ordered by incorporation date
+    # so that the min/max statistics of the row-groups allow skipping them when filtering on it
+    parquet_options_sql = "FORMAT PARQUET, COMPRESSION 'zstd', ROW_GROUP_SIZE 1000000"
 
     # export to a single clean file
     export_file = output_db_name.replace('.parquet', '') + '.parquet'
     con.execute(
         f"""
-        COPY ({combine_sql}) TO {export_file} (FORMAT PARQUET);
+        COPY ({combine_sql} ORDER BY IncorporationDate) TO {export_file} ({parquet_options_sql});
         """
     )
     print(f'Results have been exported to {export_file}')
@@ -103,10 +94,12 @@ if __name__ == '__main__':
                 T."RegAddress.AddressLine1" AS address_line,
                 T."RegAddress.PostTown" AS address_town,
                 T."RegAddress.PostCode" AS address_post_code,
+                REPLACE(SUBSTRING(T."RegAddress.PostCode", 1, STRLEN(T."RegAddress.PostCode")-2), ' ', '') AS simplified_pc,
                 T.IncorporationDate AS inc_date,
                 T."Accounts.AccountCategory" AS acc_cat
             FROM ({combine_sql}) AS T
-        ) TO {filt_export_file} (FORMAT PARQUET);
+            ORDER BY T.IncorporationDate
+        ) TO {filt_export_file} ({parquet_options_sql});
         """
     )
     print(f'Filtered results have been exported to {filt_export_file}')
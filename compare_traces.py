@@ -19,8 +19,61 @@ import plotly.graph_objects as pgo
 import numpy as np
 import poisson_trace_stats as pts
 import scipy.stats as sp_st
+import typing as tp
 
 
+######################
+@st.cache_resource
+def load_time_series_h5(
+        time_series_h5: str
+)->tp.Tuple[h5py.File, tp.List[str], tp.Dict[str, int], str, str]:
+    """
+    Open the H5 file with the time traces once, and keep it open across the reruns. Only the
+    simplified postcodes and the incorporation period get loaded, the traces are read on demand
+
+    :param time_series_h5: path to H5 with time series of company creation counts
+    :return: open H5 file handle, list of simplified postcodes, map from simplified postcode to its index,
+                period start date, period end date
+    """
+    fh = h5py.File(time_series_h5, 'r')
+    simplified_pc_list = [pc.decode('utf-8') for pc in fh['utf-8_simplified_pc_list'][:]]
+    pc_to_idx = {pc: i_pc for i_pc, pc in enumerate(simplified_pc_list)}
+    period_start_date_str = fh['utf-8_period_start_date_str'][()].decode('utf-8')
+    period_end_date_str = fh['utf-8_period_end_date_str'][()].decode('utf-8')
+
+    return fh, simplified_pc_list, pc_to_idx, period_start_date_str, period_end_date_str
+
+######################
+@st.cache_data
+def extract_rate_trace(
+        time_series_h5: str,
+        i_grouped_pc: int
+)->tp.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Read a single trace of counts from the H5 file and extract the poisson rate for it, together
+    with the 5%-95% confidence interval of counts under that rate. Cached so that the rate is only
+    recomputed when the selected trace changes
+
+    :param time_series_h5: path to H5 with time series of company creation counts
+    :param i_grouped_pc: index of the simplified postcode (row in the time series matrix)
+    :return: times and counts of the trace, times and rates extracted for it, lower and upper confidence bounds
+    """
+    fh, _, _, _, _ = load_time_series_h5(time_series_h5)
+
+    # read only the selected trace
+    count_arr = np.squeeze(fh['time_series_mat'][i_grouped_pc,:])
+    time_arr = np.arange(len(count_arr))
+
+    time_for_rate_arr, rate_arr = pts.rate_trace_extract(
+        count_arr=count_arr,
+        time_arr=time_arr
+    )
+
+    # both quantiles evaluated in one go, broadcasting over the rates
+    rate_low_arr, rate_high_arr = sp_st.poisson.ppf([0.05, 0.95], rate_arr[:, None]).T
+
+    return time_arr, count_arr, time_for_rate_arr, rate_arr, rate_low_arr, rate_high_arr
+
 ######################
 def main(
         time_series_h5: str
@@ -29,26 +82,21 @@ def main(
 
     with st.spinner('Loading data...'):
         # load time traces
-        with h5py.File(time_series_h5, 'r') as fh:
-            time_series_mat = fh['time_series_mat'][:]
-            simplified_pc_list = [pc.decode('utf-8') for pc in fh['utf-8_simplified_pc_list'][:]]
-            period_start_date_str = fh['utf-8_period_start_date_str'][()].decode('utf-8')
-            period_end_date_str = fh['utf-8_period_end_date_str'][()].decode('utf-8')
+        _, simplified_pc_list, pc_to_idx, period_start_date_str, period_end_date_str = load_time_series_h5(
+            time_series_h5
+        )
 
     ########
     selected_grouped_pc = st.selectbox('Choose an option:', simplified_pc_list)
 
     # extract rate for the trace
 
-    i_grouped_pc = simplified_pc_list.index(selected_grouped_pc)
-    count_arr = np.squeeze(time_series_mat[i_grouped_pc,:])
-    time_arr = np.arange(len(count_arr))
+    i_grouped_pc = pc_to_idx[selected_grouped_pc]
 
     with st.spinner('Computing rate...'):
-        # load time traces
-        time_for_rate_arr, rate_arr = pts.rate_trace_extract(
-            count_arr=count_arr,
-            time_arr=time_arr
+        time_arr, count_arr, time_for_rate_arr, rate_arr, rate_low_arr, rate_high_arr = extract_rate_trace(
+            time_series_h5=time_series_h5,
+            i_grouped_pc=i_grouped_pc
         )
 
     ######### plot selected trace
@@ -69,7 +117,7 @@ def main(
     ))
     fig.add_trace(pgo.Scatter(
         x=time_for_rate_arr,
-        y=sp_st.poisson(rate_arr).ppf(0.95),
+        y=rate_high_arr,
         mode='lines',
         name=f'rate confidence interval',
         fill='tonexty',
@@ -78,7 +126,7 @@ def main(
     ))
     fig.add_trace(pgo.Scatter(
         x=time_for_rate_arr,
-        y=sp_st.poisson(rate_arr).ppf(0.05),
+        y=rate_low_arr,
         mode='lines',
         name=f'rate confidence interval',
         fill='tonexty',
@@ -2,6 +2,7 @@ import pandas as pd
 import numpy as np
 import numpy.random as npr
 import numpy.polynomial as np_poly
+from numpy.lib.stride_tricks import sliding_window_view
 
 
 import scipy as sp
@@ -12,18 +13,117 @@ import sklearn as sk
 import sklearn.linear_model as sk_lm
 
 import typing as tp
+import threading
+import functools
+
+# numba is optional, without it the batched fits run in plain numpy
+try:
+    import numba
+except ImportError:
+    numba = None
 
 ##################################################
 
 
 
+def _polynomial_rate_trend_predict_impl(
+    count_arr: tp.List[int],
+    time_arr: tp.List[float],
+    predict_time: float,
+    max_rate: float=1e4,
+    poisson_fit_poly_degree: int=2,
+    poisson_fit_max_iter_count: int=1000,
+    poisson_fit_alpha: float=1.0,
+    precomputed_delay_mat: tp.Optional[np.ndarray]=None,
+    precomputed_predict_row: tp.Optional[np.ndarray]=None,
+    fast_mode: bool=False,
+    poisson_reg: tp.Optional[sk_lm.PoissonRegressor]=None
+)->float:
+    """
+    Same as `polynomial_rate_trend_predict`, but without validating the arguments, for callers
+    that have already checked them
+    """
+
+    if poisson_fit_poly_degree == 0:
+        return np.mean(count_arr)
+
+    ######
+    # prepare the delay matrix, i.e. the design matrix
+    # where each column is the time-array raised to the corresponding power
+    # skipping the zeroth power because the Poisson regressor will be allowed
+    # to fit the intercept explicitly
+    if precomputed_delay_mat is None:
+        delay_mat = np.vander(np.asarray(time_arr, dtype=float), poisson_fit_poly_degree+1, increasing=True)[:, 1:]
+    else:
+        delay_mat = precomputed_delay_mat
+
+    if precomputed_predict_row is None:
+        predict_arr = np.cumprod(np.full(poisson_fit_poly_degree, predict_time, dtype=float))[None,:]
+    else:
+        predict_arr = np.reshape(precomputed_predict_row, (1, poisson_fit_poly_degree))
+
+    if fast_mode:
+        # closed-form least-squares fit of the log-counts instead of the poisson regression,
+        # a single LAPACK call, at the cost of some bias for low counts
+        log_count_arr = np.log(np.asarray(count_arr, dtype=float) + 0.5)
+        coef_arr, _, _, _ = np.linalg.lstsq(
+            np.hstack([np.ones([len(log_count_arr), 1]), delay_mat]), log_count_arr, rcond=None
+        )
+        return np.clip(np.exp(coef_arr[0] + np.squeeze(predict_arr @ coef_arr[1:])), a_min=0.0, a_max=max_rate)
+
+    if (poisson_fit_poly_degree == 1) and (poisson_reg is None):
+        # straight line in the log-rate, the same penalised objective as the poisson regressor,
+        # mean(exp(a + b*t) - y*(a + b*t)) + alpha/2*b^2, minimised by Newton steps on the 2*2 system.
+        # Centring the times only moves the (unpenalised) intercept, and keeps the steps well behaved
+        count_arr = np.asarray(count_arr, dtype=float)
+        time_mean = np.mean(delay_mat[:, 0])
+        cent_time_arr = delay_mat[:, 0] - time_mean
+        # windows without any counts have their optimum at zero rate, so start from a negligible one
+        intercept = np.log(max(np.mean(count_arr), 1e-11))
+        slope = 0.0
+        for _ in range(poisson_fit_max_iter_count):
+            mu_arr = np.exp(intercept + slope*cent_time_arr)
+            resid_arr = mu_arr - count_arr
+            grad_a = np.mean(resid_arr)
+            grad_b = np.mean(resid_arr*cent_time_arr) + poisson_fit_alpha*slope
+            if max(abs(grad_a), abs(grad_b)) <= 1e-8:
+                break
+
+            hess_aa = np.mean(mu_arr)
+            hess_ab = np.mean(mu_arr*cent_time_arr)
+            hess_bb = np.mean(mu_arr*cent_time_arr**2) + poisson_fit_alpha
+            hess_det = hess_aa*hess_bb - hess_ab**2
+            intercept -= (hess_bb*grad_a - hess_ab*grad_b)/hess_det
+            slope -= (hess_aa*grad_b - hess_ab*grad_a)/hess_det
+
+        return np.clip(
+            np.exp(intercept + slope*(np.squeeze(predict_arr) - time_mean)), a_min=0.0, a_max=max_rate
+        )
+
+    # fit Poisson regressor
+    if poisson_reg is None:
+        poisson_reg = sk_lm.PoissonRegressor(alpha=poisson_fit_alpha, max_iter=poisson_fit_max_iter_count)
+    poisson_reg.fit(delay_mat, count_arr)
+
+    # predict the expected value, which for Poisson distribution is the rate    
+    predicted_rate = np.clip(np.squeeze(poisson_reg.predict(predict_arr)), a_min=0.0, a_max=max_rate)
+
+    return predicted_rate
+
+##########################
+
 def polynomial_rate_trend_predict(
     count_arr: tp.List[int],
     time_arr: tp.List[float],
     predict_time: float,
     max_rate: float=1e4,
     poisson_fit_poly_degree: int=2,
-    poisson_fit_max_iter_count: int=1000
+    poisson_fit_max_iter_count: int=1000,
+    poisson_fit_alpha: float=1.0,
+    precomputed_delay_mat: tp.Optional[np.ndarray]=None,
+    precomputed_predict_row: tp.Optional[np.ndarray]=None,
+    fast_mode: bool=False,
+    poisson_reg: tp.Optional[sk_lm.PoissonRegressor]=None
 )->float:
     """
     Given count data and time at which this count data was observed, use poisson regression to predict the rate 
@@ -36,8 +136,21 @@ def polynomial_rate_trend_predict(
     :param count_arr: array of counts
     :param time_arr: array of times for the counts in `count_arr`
     :param predict_time: time for which the poisson rate prediction should be generated
-    :param poisson_fit_poly_degree: degree of polynomial to fit for the dependence of rate on time. Must be at least 1, i.e. linear model
+    :param poisson_fit_poly_degree: degree of polynomial to fit for the dependence of rate on time. Must be at least 1, i.e. linear model.
+                The linear model is fitted directly with Newton steps, rather than by the poisson regressor (unless
+                `poisson_reg` is given)
     :param poisson_fit_max_iter_count: parameter for the poisson regression, number of iterations to consider
+    :param poisson_fit_alpha: parameter for the poisson regression, strength of the L2 penalty on the polynomial
+                coefficients (not the intercept)
+    :param precomputed_delay_mat: delay matrix for `time_arr` (powers 1...poisson_fit_poly_degree), if it is
+                already known, e.g. shared by many windows of equispaced data. Built from `time_arr` if None
+    :param precomputed_predict_row: same as `precomputed_delay_mat`, but for `predict_time`
+    :param fast_mode: if True, replace the poisson regression by a least-squares fit of log(counts+0.5),
+                which is much faster, but only approximate
+    :param poisson_reg: poisson regressor to (re)fit, instead of a new one built from `poisson_fit_alpha`
+                and `poisson_fit_max_iter_count`. When fitting overlapping windows one after another, pass
+                the same regressor constructed with `warm_start=True`, so that each fit starts from the
+                coefficients of the previous window, and converges in a few iterations
     :return: predicted poisson rate for time `predict_time`
     """
     
@@ -45,28 +158,337 @@ def polynomial_rate_trend_predict(
     assert len(count_arr) > poisson_fit_poly_degree, 'Number of points needed to fit the regression constants has to be at least equal to number of constants'
     assert len(count_arr)==len(time_arr)
 
-    if poisson_fit_poly_degree == 0:
-        return np.mean(count_arr)
+    return _polynomial_rate_trend_predict_impl(
+        count_arr=count_arr,
+        time_arr=time_arr,
+        predict_time=predict_time,
+        max_rate=max_rate,
+        poisson_fit_poly_degree=poisson_fit_poly_degree,
+        poisson_fit_max_iter_count=poisson_fit_max_iter_count,
+        poisson_fit_alpha=poisson_fit_alpha,
+        precomputed_delay_mat=precomputed_delay_mat,
+        precomputed_predict_row=precomputed_predict_row,
+        fast_mode=fast_mode,
+        poisson_reg=poisson_reg
+    )
 
-    ######
-    # prepare the delay matrix, i.e. the design matrix
-    # where each column is the time-array raised to the corresponding power
-    # skipping the zeroth power because the Poisson regressor will be allowed
-    # to fit the intercept explicitly
-    delay_mat = np.zeros([len(count_arr), poisson_fit_poly_degree], dtype=float)
-    #
-    for i_order in range(poisson_fit_poly_degree):
-        delay_mat[:, i_order] = time_arr[:]**(i_order+1)
+##########################
 
-    # fit Poisson regressor
-    poisson_reg = sk_lm.PoissonRegressor(max_iter=poisson_fit_max_iter_count)
-    poisson_reg.fit(delay_mat, count_arr)
+# limit on the step halvings in each Newton step of `poisson_irls_windows`
+_max_step_halving_count = 50
 
-    # predict the expected value, which for Poisson distribution is the rate    
-    predict_arr = np.array([predict_time**(i_order+1) for i_order in range(poisson_fit_poly_degree)])[None,:]
-    predicted_rate = np.clip(np.squeeze(poisson_reg.predict(predict_arr)), a_min=0.0, a_max=max_rate)
+def _poisson_windows_objective(
+    design_tensor: np.ndarray,
+    count_mat: np.ndarray,
+    penalty_mat: np.ndarray,
+    beta_mat: np.ndarray
+)->np.ndarray:
+    """
+    Penalised objective minimised by `poisson_irls_windows` for each window, without the constant
+    terms of the half-deviance. Infinite where the rate overflows
+
+    :param design_tensor: B*W*P design matrices
+    :param count_mat: B*W counts
+    :param penalty_mat: P*P penalty matrix
+    :param beta_mat: B*P coefficients
+    :return: B objective values
+    """
+    eta_mat = np.einsum('bwp,bp->bw', design_tensor, beta_mat)
+    with np.errstate(over='ignore'):
+        obj_arr = np.mean(np.exp(eta_mat) - count_mat*eta_mat, axis=1)
 
-    return predicted_rate
+    return obj_arr + 0.5*np.einsum('bp,pq,bq->b', beta_mat, penalty_mat, beta_mat)
+
+##########################
+
+def poisson_irls_windows(
+    design_tensor: np.ndarray,
+    count_mat: np.ndarray,
+    alpha: float=1.0,
+    max_iter_count: int=1000,
+    tol: float=1e-8,
+    use_numba: bool=True,
+    penalty_mat: tp.Optional[np.ndarray]=None
+)->np.ndarray:
+    """
+    Fit a separate poisson regression (log-link) to each of B windows of counts at once, using
+    batched Newton (IRLS) steps. The objective for every window is the same as in
+    `sk_lm.PoissonRegressor`, i.e. mean half-deviance plus alpha/2 times the squared norm of the
+    coefficients, with the intercept (first column of the design) not penalised
+
+    If numba is installed, the windows are fitted in parallel by `_poisson_irls_windows_numba`,
+    otherwise with stacked numpy operations
+
+    :param design_tensor: B*W*P design matrices, for B windows of W points and P coefficients, first column all ones
+    :param count_mat: B*W counts
+    :param alpha: strength of the L2 penalty
+    :param max_iter_count: maximum number of Newton steps
+    :param tol: windows are deemed converged once the largest gradient component drops below this
+    :param use_numba: use the numba kernel, when numba is available
+    :param penalty_mat: P*P matrix of the quadratic penalty, instead of alpha on all but the intercept, e.g. when
+                the design is in a different basis. The first column of the design still has to be all ones
+    :return: B*P fitted coefficients, intercept first
+    """
+    window_count, window_size, param_count = design_tensor.shape
+    count_mat = np.asarray(count_mat, dtype=float)
+
+    if penalty_mat is None:
+        penalty_mat = alpha*np.diag(np.r_[0.0, np.ones(param_count-1)])
+    penalty_mat = np.ascontiguousarray(penalty_mat, dtype=np.float64)
+
+    # start from the closed-form least-squares fit of log-counts, with the same
+    # penalty, which is typically a few Newton steps away from the solution
+    log_count_mat = np.log(count_mat + 0.5)
+    beta_mat = np.linalg.solve(
+        np.einsum('bwp,bwq->bpq', design_tensor, design_tensor)/window_size + penalty_mat[None, :, :],
+        np.einsum('bwp,bw->bp', design_tensor, log_count_mat)[:, :, None]/window_size
+    )[:, :, 0]
+    # the log shifts low counts up, so rescale to the mean count of the window. Windows
+    # without any counts have their optimum at zero rate, these start as already converged
+    beta_mat[:, 0] += np.log(np.maximum(np.mean(count_mat, axis=1), tol*1e-3)) \
+        - np.log(np.mean(np.exp(np.einsum('bwp,bp->bw', design_tensor, beta_mat)), axis=1))
+
+    if use_numba and (numba is not None):
+        if threading.current_thread() is threading.main_thread():
+            irls_kernel = _poisson_irls_windows_numba
+        else:
+            irls_kernel = _poisson_irls_windows_numba_serial
+
+        # shared (broadcast) designs are passed as they are, without copying
+        irls_kernel(
+            np.asarray(design_tensor, dtype=np.float64),
+            np.ascontiguousarray(count_mat),
+            penalty_mat,
+            beta_mat,
+            max_iter_count,
+            tol
+        )
+        return beta_mat
+
+    active_arr = np.ones(window_count, dtype=bool)
+    for i_iter in range(max_iter_count):
+        mu_mat = np.exp(np.einsum('bwp,bp->bw', design_tensor, beta_mat))
+
+        grad_mat = np.einsum('bwp,bw->bp', design_tensor, mu_mat - count_mat)/window_size + beta_mat @ penalty_mat
+        active_arr &= np.max(np.abs(grad_mat), axis=1) > tol
+        if not np.any(active_arr):
+            break
+
+        # only the windows that are still moving need their P*P systems solved
+        cur_design_tensor = design_tensor[active_arr]
+        cur_count_mat = count_mat[active_arr]
+        hess_tensor = np.einsum('bwp,bw,bwq->bpq', cur_design_tensor, mu_mat[active_arr], cur_design_tensor)/window_size \
+            + penalty_mat[None, :, :]
+        step_mat = np.linalg.solve(hess_tensor, grad_mat[active_arr][:, :, None])[:, :, 0]
+
+        # full Newton steps can overshoot for windows with sharp jumps, and overflow the exponent,
+        # so halve the step, until the objective does not increase
+        cur_beta_mat = beta_mat[active_arr]
+        cur_obj_arr = _poisson_windows_objective(cur_design_tensor, cur_count_mat, penalty_mat, cur_beta_mat)
+        step_size_arr = np.ones(len(cur_beta_mat))
+        accepted_arr = np.zeros(len(cur_beta_mat), dtype=bool)
+        for i_halving in range(_max_step_halving_count):
+            pending_arr = ~accepted_arr
+            trial_beta_mat = cur_beta_mat[pending_arr] - step_size_arr[pending_arr, None]*step_mat[pending_arr]
+            trial_obj_arr = _poisson_windows_objective(
+                cur_design_tensor[pending_arr], cur_count_mat[pending_arr], penalty_mat, trial_beta_mat
+            )
+            accepted_arr[pending_arr] = trial_obj_arr <= cur_obj_arr[pending_arr] + 1e-12*(1 + np.abs(cur_obj_arr[pending_arr]))
+            if np.all(accepted_arr):
+                break
+            step_size_arr[~accepted_arr] /= 2
+
+        # windows where no step helps are as good as converged
+        cur_beta_mat[accepted_arr] -= step_size_arr[accepted_arr, None]*step_mat[accepted_arr]
+        beta_mat[active_arr] = cur_beta_mat
+        active_arr[active_arr] = accepted_arr
+
+    return beta_mat
+
+
+if numba is not None:
+    # fastmath without the no-nans/no-infs assumptions, the step halving relies on
+    # comparisons with the objective being infinite when the rate overflows
+    _numba_fastmath_flags = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+    @numba.njit(fastmath=_numba_fastmath_flags, cache=True)
+    def _poisson_irls_window_numba(
+        design_mat: np.ndarray,
+        count_arr: np.ndarray,
+        penalty_mat: np.ndarray,
+        beta_arr: np.ndarray,
+        max_iter_count: int,
+        tol: float
+    ):
+        """
+        Numba version of the Newton steps in `poisson_irls_windows`, for a single window, including the step
+        halving. The P*P systems are tiny, so these are solved with an inlined Cholesky decomposition rather
+        than LAPACK. `beta_arr` holds the starting coefficients and is updated in place
+        """
+        window_size, param_count = design_mat.shape
+
+        grad_arr = np.empty(param_count)
+        hess_mat = np.empty((param_count, param_count))
+        chol_mat = np.zeros((param_count, param_count))
+        step_arr = np.empty(param_count)
+        trial_beta_arr = np.empty(param_count)
+
+        for i_iter in range(max_iter_count):
+            # objective, gradient and hessian of the penalised objective
+            obj = 0.0
+            for i_p in range(param_count):
+                grad_arr[i_p] = 0.0
+                for i_q in range(param_count):
+                    hess_mat[i_p, i_q] = 0.0
+
+            for i_w in range(window_size):
+                eta = 0.0
+                for i_p in range(param_count):
+                    eta += design_mat[i_w, i_p]*beta_arr[i_p]
+                mu = np.exp(eta)
+                obj += mu - count_arr[i_w]*eta
+                resid = mu - count_arr[i_w]
+                for i_p in range(param_count):
+                    x_p = design_mat[i_w, i_p]
+                    grad_arr[i_p] += x_p*resid
+                    for i_q in range(i_p+1):
+                        hess_mat[i_p, i_q] += x_p*mu*design_mat[i_w, i_q]
+
+            obj /= window_size
+            max_abs_grad = 0.0
+            for i_p in range(param_count):
+                grad_arr[i_p] /= window_size
+                for i_q in range(param_count):
+                    grad_arr[i_p] += penalty_mat[i_p, i_q]*beta_arr[i_q]
+                    obj += 0.5*beta_arr[i_p]*penalty_mat[i_p, i_q]*beta_arr[i_q]
+                max_abs_grad = max(max_abs_grad, abs(grad_arr[i_p]))
+
+            if max_abs_grad <= tol:
+                break
+
+            # lower triangular Cholesky factor of the hessian
+            for i_p in range(param_count):
+                for i_q in range(i_p+1):
+                    acc = hess_mat[i_p, i_q]/window_size + penalty_mat[i_p, i_q]
+                    for i_k in range(i_q):
+                        acc -= chol_mat[i_p, i_k]*chol_mat[i_q, i_k]
+                    if i_p == i_q:
+                        chol_mat[i_p, i_p] = np.sqrt(acc)
+                    else:
+                        chol_mat[i_p, i_q] = acc/chol_mat[i_q, i_q]
+
+            # forward, then backward substitution
+            for i_p in range(param_count):
+                acc = grad_arr[i_p]
+                for i_k in range(i_p):
+                    acc -= chol_mat[i_p, i_k]*step_arr[i_k]
+                step_arr[i_p] = acc/chol_mat[i_p, i_p]
+
+            for i_p in range(param_count-1, -1, -1):
+                acc = step_arr[i_p]
+                for i_k in range(i_p+1, param_count):
+                    acc -= chol_mat[i_k, i_p]*step_arr[i_k]
+                step_arr[i_p] = acc/chol_mat[i_p, i_p]
+
+            # halve the step until the objective does not increase
+            step_size = 1.0
+            is_accepted = False
+            for i_halving in range(_max_step_halving_count):
+                for i_p in range(param_count):
+                    trial_beta_arr[i_p] = beta_arr[i_p] - step_size*step_arr[i_p]
+
+                trial_obj = 0.0
+                for i_w in range(window_size):
+                    eta = 0.0
+                    for i_p in range(param_count):
+                        eta += design_mat[i_w, i_p]*trial_beta_arr[i_p]
+                    trial_obj += np.exp(eta) - count_arr[i_w]*eta
+                trial_obj /= window_size
+                for i_p in range(param_count):
+                    for i_q in range(param_count):
+                        trial_obj += 0.5*trial_beta_arr[i_p]*penalty_mat[i_p, i_q]*trial_beta_arr[i_q]
+
+                if trial_obj <= obj + 1e-12*(1 + abs(obj)):
+                    is_accepted = True
+                    break
+                step_size /= 2
+
+            # no step helps, as good as converged
+            if not is_accepted:
+                break
+
+            for i_p in range(param_count):
+                beta_arr[i_p] = trial_beta_arr[i_p]
+
+    @numba.njit(parallel=True, fastmath=_numba_fastmath_flags, cache=True)
+    def _poisson_irls_windows_numba(
+        design_tensor: np.ndarray,
+        count_mat: np.ndarray,
+        penalty_mat: np.ndarray,
+        beta_mat: np.ndarray,
+        max_iter_count: int,
+        tol: float
+    ):
+        """
+        Fit the windows in parallel, one window per thread, see `_poisson_irls_window_numba`
+        """
+        for i_window in numba.prange(design_tensor.shape[0]):
+            _poisson_irls_window_numba(
+                design_tensor[i_window], count_mat[i_window], penalty_mat, beta_mat[i_window], max_iter_count, tol
+            )
+
+    # the serial version is for calls outside of the main thread (e.g. streamlit scripts),
+    # since starting numba's thread pool from there can hang the interpreter at exit.
+    # It is a separate function, rather than the one above compiled without `parallel`, since
+    # the numba cache does not tell apart compilations of one function with different options
+    @numba.njit(fastmath=_numba_fastmath_flags, cache=True)
+    def _poisson_irls_windows_numba_serial(
+        design_tensor: np.ndarray,
+        count_mat: np.ndarray,
+        penalty_mat: np.ndarray,
+        beta_mat: np.ndarray,
+        max_iter_count: int,
+        tol: float
+    ):
+        """
+        Same as `_poisson_irls_windows_numba`, but fitting the windows one after another
+        """
+        for i_window in range(design_tensor.shape[0]):
+            _poisson_irls_window_numba(
+                design_tensor[i_window], count_mat[i_window], penalty_mat, beta_mat[i_window], max_iter_count, tol
+            )
+
+##########################
+
+@functools.lru_cache(maxsize=32)
+def _equispaced_design(
+    window_size: int,
+    poly_degree: int
+)->tp.Tuple[np.ndarray, np.ndarray]:
+    """
+    Design matrix shared by all windows of an equispaced trace with unit time step, in the orthonormal basis
+    used by `rate_trace_extract`. The window times are [-window_size+1, ..., 0], and the powers of time
+    factorise as vander = ortho_design_mat @ basis_r_mat, with the first column of ortho_design_mat all ones.
+    Cached, since it only depends on the window size and the degree, so both arrays are read-only
+
+    For time step dt, the powers of time only get their columns scaled by dt^p, so the orthonormal basis is the
+    same, and the inverse of basis_r_mat has its rows divided by dt^p
+
+    :param window_size: number of points in the window
+    :param poly_degree: degree of the polynomial
+    :return: W*P orthonormal design matrix (columns scaled to mean square of one), P*P inverse of basis_r_mat
+    """
+    design_mat = np.vander(np.arange(-window_size+1, 1, dtype=np.float64), poly_degree+1, increasing=True)
+
+    basis_q_mat, basis_r_mat = np.linalg.qr(design_mat)
+    basis_sign_arr = np.sign(np.diag(basis_r_mat))
+    ortho_design_mat = basis_q_mat*basis_sign_arr*np.sqrt(window_size)
+    inv_basis_r_mat = np.linalg.inv(basis_sign_arr[:, None]*basis_r_mat/np.sqrt(window_size))
+
+    ortho_design_mat.flags.writeable = False
+    inv_basis_r_mat.flags.writeable = False
+
+    return ortho_design_mat, inv_basis_r_mat
 
 ##########################
 
@@ -75,11 +497,13 @@ def rate_trace_extract(
     time_arr: tp.Optional[tp.List[float]]=None,
     poisson_fit_window_size: int=6,
     poisson_fit_poly_degree: int=2,
-    poisson_fit_max_iter_count: int=1000
+    poisson_fit_max_iter_count: int=1000,
+    poisson_fit_alpha: float=1.0
 )->tp.Tuple[tp.List[float], tp.List[float]]:
     """
     Extract possion rate of counts for a trace of counts. For each position, select a window of preceding counts, 
-    and use `polynomial_rate_trend_predict` to predict the rate for the current position
+    and fit the same polynomial poisson regression as `polynomial_rate_trend_predict` to predict the rate for
+    the current position. All windows are fitted together, see `poisson_irls_windows`
 
     Returns the poisson rates and the times for these rates. The rates for times that
     occur within the `poisson_fit_window_size`, at the beginning, are not computed,
@@ -89,7 +513,8 @@ def rate_trace_extract(
     :param time_arr: array of times for the counts in `count_arr`
     :param poisson_fit_window_size: Window of preceding counts that will be used to estimate the current poisson rate
     :param poisson_fit_poly_degree: see `polynomial_rate_trend_predict` 
-    :param poisson_fit_max_iter_count: see `polynomial_rate_trend_predict`
+    :param poisson_fit_max_iter_count: maximum number of Newton steps, see `poisson_irls_windows`
+    :param poisson_fit_alpha: see `polynomial_rate_trend_predict`
     :return:   predicted_time_arr - times
                 predicted_rate_arr - rates
     """
@@ -97,58 +522,124 @@ def rate_trace_extract(
     assert len(count_arr) > poisson_fit_window_size, 'Fit window size has to be smaller than the full count time series'
     assert (time_arr is None) or (len(time_arr)==len(count_arr)), \
         'If time array is given, the length of the time array must be the same as that of count array'
-    
-    predicted_rate_arr = np.zeros(len(count_arr)-poisson_fit_window_size, dtype=float)
-    predicted_time_arr = np.zeros_like(predicted_rate_arr)
+    assert poisson_fit_poly_degree >= 0, 'Polynomial degree must be greater than zero'
+    assert poisson_fit_window_size > poisson_fit_poly_degree, \
+        'Number of points needed to fit the regression constants has to be at least equal to number of constants'
+
+    # contiguous float arrays, converted once, for the vectorised operations below
+    count_arr = np.ascontiguousarray(count_arr, dtype=np.float64)
 
     # prepare time array, if it missing
     # assume equispaced data with later times occuring in higher indices
     if time_arr is None:
-        time_arr = np.arange(len(count_arr)).astype(float)
-
-    # order counts by increasing time
-    i_temporal_order = np.argsort(time_arr)
-    time_arr = time_arr[i_temporal_order]
-    count_arr = count_arr[i_temporal_order]
-
-    # step through time and count arrays
-    for i_pt in range(poisson_fit_window_size, len(count_arr)):
-        prior_count_arr = count_arr[(i_pt-poisson_fit_window_size):i_pt]
-        
-        # arrange time in such a way that it
-        # is measured relative to time in the step just before
-        # the current step
-        # so if window size is six, then
-        # rel_prior_time_arr = [-5, -4, -3, -2, -1, 0]
-        # and rel_cur_time = 1
-        # this should produce stable numerical behaviour
-        rel_prior_time_arr = time_arr[(i_pt-poisson_fit_window_size):i_pt]
-        rel_prior_time_arr -= time_arr[i_pt-1]
-        rel_cur_time = time_arr[i_pt] - time_arr[i_pt-1]
-    
-        # get the current rate
-        cur_rate = polynomial_rate_trend_predict(
-            count_arr=prior_count_arr,
-            time_arr=rel_prior_time_arr,
-            poisson_fit_poly_degree=poisson_fit_poly_degree,
-            predict_time=rel_cur_time,
-            max_rate=np.mean(prior_count_arr)*10
+        time_arr = np.arange(len(count_arr), dtype=np.float64)
+    else:
+        time_arr = np.ascontiguousarray(time_arr, dtype=np.float64)
+
+        # order counts by increasing time, unless they are already ordered
+        if not np.all(np.diff(time_arr) >= 0):
+            i_temporal_order = np.argsort(time_arr, kind='stable')
+            time_arr = time_arr[i_temporal_order]
+            count_arr = count_arr[i_temporal_order]
+
+    # windows of preceding counts, one row for each predicted point,
+    # this is a view into the count array, nothing gets copied
+    prior_count_mat = sliding_window_view(count_arr[:-1], poisson_fit_window_size)
+
+    # copied, since for float64 input time_arr can still be the caller's array
+    predicted_time_arr = time_arr[poisson_fit_window_size:].copy()
+    mean_count_arr = np.mean(prior_count_mat, axis=1)
+
+    if poisson_fit_poly_degree == 0:
+        return predicted_time_arr, mean_count_arr
+
+    # arrange time in such a way that it
+    # is measured relative to time in the step just before
+    # the current step
+    # so if window size is six, then
+    # rel_prior_time_arr = [-5, -4, -3, -2, -1, 0]
+    # and rel_cur_time = 1
+    # this should produce stable numerical behaviour
+    #
+    # design matrices, each column is the time raised to the corresponding power,
+    # the zeroth power is the intercept
+    time_step_arr = np.diff(time_arr)
+    if (time_step_arr[0] > 0) and np.allclose(time_step_arr, time_step_arr[0]):
+        # equispaced data, every window has the same relative times,
+        # so a single design matrix gets shared by all of the windows
+        predict_arr = np.vander(time_step_arr[:1], poisson_fit_poly_degree+1, increasing=True)
+
+        # swap the powers of time for an orthonormal basis over the window, design_mat = ortho_design_mat @ basis_r_mat,
+        # which is much better conditioned. The first column stays all ones. The penalty and the prediction
+        # row are transformed accordingly, so the optimum is the same as for the powers of time
+        ortho_design_mat, unit_inv_basis_r_mat = _equispaced_design(poisson_fit_window_size, poisson_fit_poly_degree)
+        inv_basis_r_mat = unit_inv_basis_r_mat/(time_step_arr[0]**np.arange(poisson_fit_poly_degree+1))[:, None]
+        penalty_mat = poisson_fit_alpha*inv_basis_r_mat.T @ np.diag(np.r_[0.0, np.ones(poisson_fit_poly_degree)]) \
+            @ inv_basis_r_mat
+
+        design_tensor = np.broadcast_to(ortho_design_mat, (len(prior_count_mat),) + ortho_design_mat.shape)
+        predict_mat = np.broadcast_to(
+            predict_arr @ inv_basis_r_mat,
+            (len(prior_count_mat), poisson_fit_poly_degree+1)
         )
-        #
-        predicted_rate_arr[i_pt-poisson_fit_window_size] = cur_rate
-        predicted_time_arr[i_pt-poisson_fit_window_size] = time_arr[i_pt] 
+    else:
+        prior_time_mat = sliding_window_view(time_arr[:-1], poisson_fit_window_size)
+        rel_prior_time_mat = prior_time_mat - prior_time_mat[:, -1:]
+        rel_cur_time_arr = time_arr[poisson_fit_window_size:] - time_arr[(poisson_fit_window_size-1):-1]
+
+        design_tensor = np.vander(
+            rel_prior_time_mat.ravel(), poisson_fit_poly_degree+1, increasing=True
+        ).reshape(rel_prior_time_mat.shape + (poisson_fit_poly_degree+1,))
+        predict_mat = np.vander(rel_cur_time_arr, poisson_fit_poly_degree+1, increasing=True)
+        penalty_mat = None
+
+    beta_mat = poisson_irls_windows(
+        design_tensor=design_tensor,
+        count_mat=prior_count_mat,
+        alpha=poisson_fit_alpha,
+        max_iter_count=poisson_fit_max_iter_count,
+        penalty_mat=penalty_mat
+    )
+
+    # predict the expected value, which for Poisson distribution is the rate
+    predicted_rate_arr = np.clip(
+        np.exp(np.sum(predict_mat*beta_mat, axis=1)),
+        a_min=0.0,
+        a_max=mean_count_arr*10
+    )
 
     return predicted_time_arr, predicted_rate_arr
 
 
 ##############################
 
+def _histogram_bin_counts(
+    cum_lkhd_arr: np.ndarray,
+    bin_count: int
+)->np.ndarray:
+    """
+    Histogram of cumulative likelihoods, with `bin_count` equal bins spanning [0, 1]. Since the bins
+    are uniform, the bin index is found by scaling, and the counting is done by `np.bincount`, rather
+    than searching for the bin edges as `np.histogram` does. Values that stray slightly outside
+    of [0, 1] due to rounding are put into the first or the last bin
+
+    :param cum_lkhd_arr: array of cumulative likelihoods
+    :param bin_count: number of bins
+    :return: array of bin_count counts
+    """
+    bin_idx_arr = np.clip((np.asarray(cum_lkhd_arr)*bin_count).astype(np.intp), 0, bin_count-1)
+
+    return np.bincount(bin_idx_arr, minlength=bin_count)
+
+##############################
+
 
 def simulate_cumulative_likelihood_sample(
     rate_option_arr: tp.List[float],
     sample_count: int=1000,
     entropy_bin_count: int=20,
-    eps: float=1e-6
+    eps: float=1e-6,
+    rng: tp.Optional[npr.Generator]=None
 )->tp.Tuple[tp.List[float], float]:
     """
     Given an array of possible Poisson rates, simulate random counts with these rates
@@ -160,21 +651,30 @@ def simulate_cumulative_likelihood_sample(
     :param count_arr: array of options for poisson rates
     :param sample_count: number of samples to draw for each histogram of likelihoods
     :param entropy_bin_count: number of bins for the histogram of likelihoods
-    :param eps: number deemed to be small enough (in comparison with likelihoods)
-    :return:   cumulative likelihood array, entropy computed from the histogram of this array
+    :param eps: number deemed to be small enough (in comparison with likelihoods). Not used anymore, the
+                likelihoods are clipped into the histogram range, see `_histogram_bin_counts`
+    :param rng: random number generator to draw the rates and counts from, e.g. a seeded one for reproducible
+                samples. A new, unseeded, generator is used if None
+    :return:   cumulative likelihood array, shannon entropy (in nats) computed from the histogram of this array
     """
 
     assert sample_count>0
     assert entropy_bin_count>1
     assert len(rate_option_arr)>0
 
-    rate_arr = npr.choice(rate_option_arr, replace=True, size=sample_count)
-    count_arr = sp_st.poisson(rate_arr).rvs()
+    if rng is None:
+        rng = npr.default_rng()
+
+    rate_arr = rng.choice(rate_option_arr, replace=True, size=sample_count)
+    count_arr = rng.poisson(rate_arr)
     
-    cumulative_likelihood_arr = sp_st.poisson(rate_arr).cdf(count_arr)
+    # pdtr is exactly the poisson CDF, without the overhead of building a frozen distribution
+    cumulative_likelihood_arr = sp_sp.pdtr(count_arr, rate_arr)
 
-    bin_counts, _ = np.histogram(cumulative_likelihood_arr, bins=np.linspace(0-eps, 1+eps, entropy_bin_count+1))
-    hist_entropy = np.sum([np.log(c)/c for c in bin_counts if c>0])
+    bin_counts = _histogram_bin_counts(cumulative_likelihood_arr, entropy_bin_count)
+    # shannon entropy of the normalised histogram, xlogy gives zero for the empty bins
+    bin_prob_arr = bin_counts/np.sum(bin_counts)
+    hist_entropy = -np.sum(sp_sp.xlogy(bin_prob_arr, bin_prob_arr))
     
     return cumulative_likelihood_arr, hist_entropy
 
@@ -192,17 +692,27 @@ def compute_histogram_entropy_poisson(
     Given an array of poisson rates and the corresponding array of counts
     compute the cumulative likelihood of these counts under these rates. 
     Bin the cumulative likelihood into a histogram, then compute the
-    entropy of that histogram
+    (shannon) entropy of that histogram
 
     :param poisson_rate_arr: array of rates for the poisson distribution
     :counts_arr: counts for these rates (observed)
     :histogram_bin_count: number of bins in the histogram of the cumulative likelihoods
-    :param eps: small number compared to likelihoods
+    :param eps: small number compared to likelihoods. Not used anymore, see `_histogram_bin_counts`
     :return: entropy of the histogram
     """
     
-    cum_lkhd_arr = sp_st.poisson(poisson_rate_arr).cdf(counts_arr)
-    bin_counts, _ = np.histogram(cum_lkhd_arr, bins=np.linspace(0-eps, 1+eps, histogram_bin_count+1))
-    measured_hist_entropy = np.sum([np.log(c)/c for c in bin_counts if c>0])
+    # plain float arrays, validated once here, so that pdtr goes straight to the ufunc loop
+    poisson_rate_arr = np.asarray(poisson_rate_arr, dtype=np.float64)
+    counts_arr = np.asarray(counts_arr, dtype=np.float64)
+    assert np.all(poisson_rate_arr >= 0), 'Poisson rates must not be negative'
+    assert np.all(counts_arr >= 0), 'Counts must not be negative'
+
+    # the poisson CDF for (integer) counts k is the regularised upper incomplete gamma function Q(k+1, rate),
+    # which is what pdtr evaluates too, only without flooring the counts first
+    cum_lkhd_arr = sp_sp.gammaincc(counts_arr + 1.0, poisson_rate_arr)
+    bin_counts = _histogram_bin_counts(cum_lkhd_arr, histogram_bin_count)
+    # shannon entropy of the normalised histogram, see `simulate_cumulative_likelihood_sample`
+    bin_prob_arr = bin_counts/np.sum(bin_counts)
+    measured_hist_entropy = -np.sum(sp_sp.xlogy(bin_prob_arr, bin_prob_arr))
 
     return measured_hist_entropy
\ No newline at end of file
@@ -0,0 +1,45 @@
+"""
+Regression checks for `poisson_trace_stats.py`, run with
+
+```
+python -m pytest test_poisson_trace_stats.py
+```
+"""
+
+import numpy as np
+import pytest
+import poisson_trace_stats as pts
+
+
+##########################
+
+@pytest.mark.parametrize('use_numba', [False, True])
+def test_poisson_irls_windows_sharp_jump(use_numba: bool):
+    # a window with a sharp jump, where undamped Newton steps overshoot and overflow the rate,
+    # the baseline sklearn PoissonRegressor predicts ~31750 for the next month
+    count_arr = np.array([1500, 1500, 0, 0, 0, 3000], dtype=float)
+    design_mat = np.vander(np.arange(-5, 1, dtype=float), 3, increasing=True)
+
+    beta_mat = pts.poisson_irls_windows(
+        design_tensor=design_mat[None, :, :],
+        count_mat=count_arr[None, :],
+        use_numba=use_numba
+    )
+    predicted_rate = np.exp(np.sum(beta_mat[0]))
+
+    assert np.isfinite(predicted_rate)
+    assert predicted_rate == pytest.approx(31750, rel=1e-3)
+
+##########################
+
+@pytest.mark.parametrize('count_arr, window_size, poly_degree', [
+    (np.array([1500, 1500, 0, 0, 0, 3000, 0]), 6, 2),
+    (np.r_[np.zeros(10), 100, np.zeros(10)], 12, 5)
+])
+def test_rate_trace_extract_finite(count_arr: np.ndarray, window_size: int, poly_degree: int):
+    _, rate_arr = pts.rate_trace_extract(
+        count_arr, poisson_fit_window_size=window_size, poisson_fit_poly_degree=poly_degree
+    )
+
+    assert np.all(np.isfinite(rate_arr))
+    assert np.all(rate_arr >= 0)